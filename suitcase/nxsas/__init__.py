@@ -4,12 +4,13 @@
 # but may also accept additional required or optional keyword arguments, as
 # needed.
 import collections
-import copy
 import logging
+import mmap
 import os
 from pathlib import Path
 
 import h5py
+import hdf5plugin
 import numpy as np
 
 import event_model
@@ -18,6 +19,7 @@ from suitcase.utils import ModeError, SuitcaseUtilsValueError
 from .utils import (
     _copy_nexus_md_to_nexus_h5,
     _copy_metadata_to_h5_datasets,
+    _create_h5_group,
 )
 
 from ._version import get_versions
@@ -142,17 +144,16 @@ class FileManager:
         -------
         abs_file_path : Path
         """
-        if Path(relative_file_path).is_absolute():
+        relative_file_path = Path(relative_file_path)
+        if relative_file_path.is_absolute():
             raise SuitcaseUtilsValueError(
-                f"{relative_file_path!r} must be structured like a relative "
+                f"{os.fspath(relative_file_path)!r} must be structured like a relative "
                 f"file path."
             )
-        abs_file_path = (
-            (self.directory / Path(relative_file_path)).expanduser().resolve()
-        )
+        abs_file_path = (self.directory / relative_file_path).expanduser().resolve()
         if abs_file_path in self._reserved_names:
             raise SuitcaseUtilsValueError(
-                f"Relative path {relative_file_path!r} has already been used."
+                f"Relative path {os.fspath(relative_file_path)!r} has already been used."
             )
         self._reserved_names.add(abs_file_path)
         self._artifacts[content_desc].append(abs_file_path)
@@ -234,8 +235,55 @@ class Serializer(event_model.SingleRunDocumentRouter):
         present and unique. A more descriptive value depends on the application
         and is therefore left to the user.
 
+    compression : str, int, tuple, or h5py filter, optional
+        Compression filter applied to "array" event datasets, such as detector
+        frames. The default is bitshuffle+LZ4 from ``hdf5plugin``. Use ``None``
+        to write uncompressed datasets. A tuple such as ``("gzip", 4)`` gives
+        the filter and its options together, and can not be combined with
+        ``compression_opts``. Scalar event datasets and
+        variable-length strings are not compressed. Timestamps and
+        fixed-length strings are always compressed with the lossless shuffle
+        and deflate filters built into every HDF5 library.
+
+    compression_opts : optional
+        Options for the compression filter, passed through to
+        ``h5py.Group.create_dataset``.
+
+    shuffle : bool, optional
+        Apply the HDF5 byte-shuffle filter to "array" event datasets.
+
+    data_key_compression : dict, optional
+        Filter options for the event datasets of particular data_keys, for
+        example ``{"en_energy": {"compression": "gzip", "shuffle": True}}``.
+        Each value is a dict of ``h5py.Group.create_dataset`` keyword arguments
+        such as ``compression``, ``compression_opts``, ``shuffle``, and
+        ``scaleoffset``. It replaces the default filter options for that
+        data_key, including for non-"array" data_keys.
+
+    chunk_nbytes : int, optional
+        Target size in bytes of one chunk of an event dataset. The number of
+        rows per chunk is chosen to fill about this many bytes, but is at least
+        1 and at most 1024. The default is 1MiB.
+
+    scalar_metadata_as_attrs : bool, optional
+        Store scalar values from the start, descriptor, and stop documents,
+        such as str, int, and float, as attributes of the corresponding h5
+        group rather than as datasets. This writes much less h5 metadata for
+        large documents, but NeXus links can only refer to datasets, so the
+        default is False.
+
     **kwargs : kwargs
-        Keyword arguments to be passed through to the underlying I/O library.
+        Keyword arguments to be passed through to the underlying I/O library,
+        ``h5py.File``. The defaults are ``libver="latest"``,
+        ``track_order=False``, and paged file space allocation with
+        ``fs_strategy="page"`` and ``fs_page_size=64 * 2 ** 10``. The raw
+        data chunk cache keeps the HDF5 default size of 1MiB per dataset since
+        event data is written one whole chunk at a time; ``rdcc_nbytes`` and
+        ``rdcc_nslots`` can enlarge it.
+        Other file drivers and layouts can be chosen here, for example
+        ``driver="core", backing_store=True`` to build the file in memory and
+        write it once when it is closed, or ``alignment_threshold`` and
+        ``alignment_interval`` to align large chunks to file system blocks.
 
     Attributes
     ----------
@@ -244,12 +292,23 @@ class Serializer(event_model.SingleRunDocumentRouter):
         whatever resources are produced by the Manager)
     """
 
-    def __init__(self, directory, file_prefix="{uid}-", **kwargs):
+    def __init__(
+        self,
+        directory,
+        file_prefix="{uid}-",
+        compression=hdf5plugin.Bitshuffle(cname="lz4"),
+        compression_opts=None,
+        shuffle=False,
+        data_key_compression=None,
+        chunk_nbytes=2 ** 20,
+        scalar_metadata_as_attrs=False,
+        **kwargs,
+    ):
         super().__init__()
         self.log = logging.getLogger("suitcase.nxsas")
 
         if isinstance(directory, (str, Path)):
-            directory = Path(directory)
+            # FileManager converts directory to a Path
             self._manager = FileManager(
                 directory=directory, allowed_modes={"w"}, open_file_fn=h5py.File
             )
@@ -258,9 +317,42 @@ class Serializer(event_model.SingleRunDocumentRouter):
 
         self._file_prefix = file_prefix
 
+        # filter options for "array" event datasets
+        if isinstance(compression, tuple):
+            if compression_opts is not None:
+                raise ValueError(
+                    f"compression {compression} includes filter options so "
+                    f"compression_opts {compression_opts} can not also be given"
+                )
+            compression, compression_opts = compression
+        self._array_compression_kwargs = {
+            "compression": compression,
+            "compression_opts": compression_opts,
+            "shuffle": shuffle,
+        }
+        # filter options for the event datasets of particular data_keys
+        if data_key_compression is None:
+            self._data_key_compression_kwargs = dict()
+        else:
+            self._data_key_compression_kwargs = data_key_compression
+        self._chunk_nbytes = chunk_nbytes
+        self._scalar_metadata_as_attrs = scalar_metadata_as_attrs
+
         self._kwargs = kwargs
 
         self._h5_output_file = None
+        # top-level groups, created by start()
+        self._h5_bluesky_group = None
+        self._h5_descriptors_group = None
+        self._h5_events_group = None
+        self._h5_stop_group = None
+
+        # h5py groups and datasets for each stream, filled in by descriptor()
+        # and event_page() so they are not looked up by name for every event page
+        self._stream_cache = dict()
+        # the same stream caches by descriptor uid, an event page
+        # refers to its descriptor by uid rather than by stream name
+        self._descriptor_stream_cache = dict()
 
         self.bluesky_h5_group_name = "bluesky"
 
@@ -281,6 +373,10 @@ class Serializer(event_model.SingleRunDocumentRouter):
         """
         Close all of the resources (e.g. files) allocated.
         """
+        # event data is still buffered if the run did not stop
+        # an h5py File is False once it has been closed
+        if self._h5_output_file:
+            self.flush()
         self._manager.close()
 
     # These methods enable the Serializer to be used as a context manager:
@@ -321,29 +417,58 @@ class Serializer(event_model.SingleRunDocumentRouter):
         # Fill in the file_prefix with the contents of the RunStart document.
         # As in, '{uid}' -> 'c1790369-e4b2-46c7-a294-7abfa239691a'
         # or 'my-data-from-{plan-name}' -> 'my-data-from-scan'
+        # format_map looks up only the fields named in the template
+        # rather than unpacking the whole start document into kwargs
         self.log.info("new run detected uid=%s", start_doc["uid"])
-        relative_file_path = Path(self._file_prefix.format(**start_doc) + ".h5")
+        relative_file_path = self._file_prefix.format_map(start_doc) + ".h5"
 
         self.log.info(
             "creating %s in directory %s", relative_file_path, self._manager.directory
         )
 
-        # self.output_filepath = self.directory / self.filename
+        # keep the default 1MiB raw data chunk cache, event datasets are
+        # written a whole chunk at a time so a larger cache would only hold
+        # more dirty chunks in memory until the file is closed
+        # use the latest file format for its more compact and faster
+        # metadata structures, and do not track creation order
+        # aggregate small allocations such as h5 metadata into pages
+        # so they are written and read back in a few aligned blocks,
+        # a small page size keeps files from small runs small
+        # any of these may be overridden by the Serializer kwargs
+        h5_file_kwargs = {
+            "libver": "latest",
+            "track_order": False,
+            "fs_strategy": "page",
+            "fs_page_size": 64 * 2 ** 10,
+            **self._kwargs,
+        }
         self._h5_output_file = self._manager.open(
-            content_desc="stream_data", relative_file_path=relative_file_path, mode="w"
+            content_desc="stream_data",
+            relative_file_path=relative_file_path,
+            mode="w",
+            **h5_file_kwargs,
         )
 
         # create a top-level group to hold bluesky document information
-        h5_bluesky_group = self._h5_output_file.create_group(self.bluesky_h5_group_name)
+        # keep the top-level groups so they are not looked up by name later
+        self._h5_bluesky_group = _create_h5_group(
+            self._h5_output_file, self.bluesky_h5_group_name
+        )
 
         # create the start group and copy the start document to it
-        h5_start_group = h5_bluesky_group.create_group("start")
-        _copy_metadata_to_h5_datasets(a_mapping=start_doc, h5_group=h5_start_group)
+        h5_start_group = _create_h5_group(self._h5_bluesky_group, "start")
+        _copy_metadata_to_h5_datasets(
+            a_mapping=start_doc,
+            h5_group=h5_start_group,
+            scalars_as_attrs=self._scalar_metadata_as_attrs,
+        )
 
         # create groups for descriptors, events, and stop documents
-        h5_bluesky_group.create_group("descriptors")
-        h5_bluesky_group.create_group("events")
-        h5_bluesky_group.create_group("stop")
+        self._h5_descriptors_group = _create_h5_group(
+            self._h5_bluesky_group, "descriptors"
+        )
+        self._h5_events_group = _create_h5_group(self._h5_bluesky_group, "events")
+        self._h5_stop_group = _create_h5_group(self._h5_bluesky_group, "stop")
 
     def descriptor(self, descriptor_doc):
         """
@@ -372,25 +497,114 @@ class Serializer(event_model.SingleRunDocumentRouter):
         """
         super().descriptor(descriptor_doc)
 
-        h5_bluesky_group = self._h5_output_file[self.bluesky_h5_group_name]
-        h5_bluesky_descriptors_group = h5_bluesky_group["descriptors"]
+        stream_name = descriptor_doc["name"]
+        if stream_name in self._stream_cache:
+            # a stream may have more than one descriptor document
+            # the groups for this stream have already been created
+            # and events can be appended only to existing datasets
+            # with the dtypes and shapes of the first descriptor
+            stream_data_key_layouts = self._stream_cache[stream_name]["data_key_layouts"]
+            data_key_layouts = get_data_key_layouts(descriptor_doc["data_keys"])
+            if data_key_layouts != stream_data_key_layouts:
+                mismatched_data_keys = sorted(
+                    data_key
+                    for data_key in data_key_layouts.keys() | stream_data_key_layouts.keys()
+                    if data_key_layouts.get(data_key) != stream_data_key_layouts.get(data_key)
+                )
+                raise ValueError(
+                    f"descriptor {descriptor_doc['uid']} for stream '{stream_name}' "
+                    f"does not match an earlier descriptor for this stream, data_keys "
+                    f"{mismatched_data_keys} are missing from one of them or have a "
+                    f"different dtype, shape, or dtype_numpy"
+                )
+            self.log.info(
+                "stream %s already has a descriptor, ignoring descriptor %s",
+                stream_name,
+                descriptor_doc["uid"],
+            )
+            self._descriptor_stream_cache[descriptor_doc["uid"]] = self._stream_cache[
+                stream_name
+            ]
+            return
 
         # create a group for this descriptor, use the stream name
         # copy the descriptor document metadata to H5 datasets
-        stream_name = descriptor_doc["name"]
-        h5_descriptor_stream_group = h5_bluesky_descriptors_group.create_group(
-            stream_name
+        h5_descriptor_stream_group = _create_h5_group(
+            self._h5_descriptors_group, stream_name
         )
         _copy_metadata_to_h5_datasets(
-            a_mapping=descriptor_doc, h5_group=h5_descriptor_stream_group
+            a_mapping=descriptor_doc,
+            h5_group=h5_descriptor_stream_group,
+            scalars_as_attrs=self._scalar_metadata_as_attrs,
         )
 
-        # create a group to hold datasets
-        # each row of a dataset will be read from an event_page document
-        h5_bluesky_group["events"].create_group(stream_name).create_group("data")
+        h5_event_stream_group = _create_h5_group(self._h5_events_group, stream_name)
+
+        # resolve the h5 dtype and extra dataset kwargs for each data_key once
+        # the dtype of an "array" data_key is taken from the first event page
+        # also keep the descriptor shape of each "array" data_key to be checked
+        # against the first event page without reading it back from the h5 file
+        h5_dtypes = dict()
+        descriptor_shapes = dict()
+        fixed_length_string_dtypes = dict()
+        for data_key, data_key_info in descriptor_doc["data_keys"].items():
+            if data_key_info["dtype"] == "array":
+                # compress large arrays such as detector frames
+                h5_dtypes[data_key] = (None, self._array_compression_kwargs)
+                descriptor_shapes[data_key] = tuple(data_key_info["shape"])
+            else:
+                h5_dtype = get_h5_dtype_from_descriptor_dtype(
+                    descriptor_dtype=data_key_info["dtype"],
+                    ep_data_key=data_key,
+                    ep_data_list=None,
+                    dtype_numpy=data_key_info.get("dtype_numpy", None),
+                )
+                if np.dtype(h5_dtype).kind == "S":
+                    fixed_length_string_dtypes[data_key] = h5_dtype
+                    h5_dtypes[data_key] = (
+                        h5_dtype,
+                        _fixed_length_string_compression_kwargs,
+                    )
+                else:
+                    h5_dtypes[data_key] = (h5_dtype, {})
+            if data_key in self._data_key_compression_kwargs:
+                h5_dtypes[data_key] = (
+                    h5_dtypes[data_key][0],
+                    self._data_key_compression_kwargs[data_key],
+                )
 
-        # create a group to hold timestamps
-        h5_bluesky_group["events"][stream_name].create_group("timestamps")
+        num_points = self.get_start().get("num_points", None)
+        if stream_name == "primary" and isinstance(num_points, int):
+            expected_rows = num_points
+        else:
+            expected_rows = None
+
+        self._stream_cache[stream_name] = {
+            "descriptor_group": h5_descriptor_stream_group,
+            # a later descriptor for this stream must match these
+            "data_key_layouts": get_data_key_layouts(descriptor_doc["data_keys"]),
+            # (h5 dtype, extra create_dataset kwargs) by data_key
+            "h5_dtypes": h5_dtypes,
+            "descriptor_shapes": descriptor_shapes,
+            # fixed-length string h5 dtypes by data_key, strings
+            # for these data_keys must be encoded before writing
+            "fixed_length_string_dtypes": fixed_length_string_dtypes,
+            # create a group to hold datasets
+            # each row of a dataset will be read from an event_page document
+            "data_group": _create_h5_group(h5_event_stream_group, "data"),
+            # create a group to hold timestamps
+            "timestamps_group": _create_h5_group(h5_event_stream_group, "timestamps"),
+            # BufferedDatasetAppenders for the data and timestamps
+            # datasets by data_key, created when the first event page arrives
+            "appenders": dict(),
+            "timestamps_appenders": dict(),
+            # the number of events expected in the primary stream
+            # is often known, do not guess for other streams
+            "expected_rows": expected_rows,
+        }
+        self._descriptor_stream_cache[descriptor_doc["uid"]] = self._stream_cache[
+            stream_name
+        ]
 
     def event_page(self, event_page_doc):
         """
@@ -447,23 +661,41 @@ class Serializer(event_model.SingleRunDocumentRouter):
         # 'bulk_events' (deprecated). But that does not concern us because
         # DocumentRouter will convert these representations to 'event_page'
         # then route them through here.
-        stream_name = self.get_stream_name(doc=event_page_doc)
-
-        h5_descriptor_stream_group = self._h5_output_file[self.bluesky_h5_group_name][
-            "descriptors"
-        ][stream_name]
-        h5_event_stream_group = self._h5_output_file[self.bluesky_h5_group_name][
-            "events"
-        ][stream_name]
-        h5_event_stream_data_group = h5_event_stream_group["data"]
-        h5_event_stream_data_timestamps_group = h5_event_stream_group["timestamps"]
-
-        for ep_data_key, ep_data_list in event_page_doc["data"].items():
-            if event_page_doc["filled"].get(ep_data_key, None) is False:
+        stream_cache = self._descriptor_stream_cache[event_page_doc["descriptor"]]
+        appenders = stream_cache["appenders"]
+        timestamps_appenders = stream_cache["timestamps_appenders"]
+        fixed_length_string_dtypes = stream_cache["fixed_length_string_dtypes"]
+
+        ep_timestamps = event_page_doc["timestamps"]
+        ep_filled = event_page_doc["filled"]
+        ep_data = event_page_doc["data"]
+        # check and encode every data_key before appending any rows so
+        # an invalid event page leaves all datasets of the stream with
+        # the same number of rows
+        for ep_data_key in ep_data:
+            if ep_filled.get(ep_data_key, None) is False:
                 raise ValueError(
                     f"data_key {ep_data_key} must be filled "
-                    f" in stream/event/run: {stream_name}/{event_page_doc['uid']}/{self.get_start()['uid']}"
+                    f" in stream/event/run: {self.get_stream_name(doc=event_page_doc)}"
+                    f"/{event_page_doc['uid']}/{self.get_start()['uid']}"
                 )
+        if fixed_length_string_dtypes:
+            # do not modify the event page document
+            ep_data = dict(ep_data)
+            for ep_data_key, h5_dtype in fixed_length_string_dtypes.items():
+                if ep_data_key not in ep_data:
+                    continue
+                try:
+                    ep_data[ep_data_key] = encode_fixed_length_strings(
+                        strings=ep_data[ep_data_key], h5_dtype=h5_dtype,
+                    )
+                except ValueError as err:
+                    raise ValueError(
+                        f"data_key {ep_data_key} has a string longer than the descriptor "
+                        f"dtype_numpy allows: {err}"
+                    ) from err
+
+        for ep_data_key, ep_data_list in ep_data.items():
             # Data in an event_page will *always* be inside a list because
             # an event_page contains data from one or more events.
             # ep_data_list will have only one element if the event page
@@ -472,64 +704,84 @@ class Serializer(event_model.SingleRunDocumentRouter):
             #    scalar per event                : ep_data_list = [1.0, 2.0, ...]
             #    one-dimensional array per event : ep_data_list = [[1, 2, ...], [3, 4, ...], ...]
 
-            # convert the event page list of data to an array
-            # this way there is a .shape to work with
-            # TODO: could we get a list of things with different sizes and fail here?
-            # TODO: this seems to be a deprecated use of np.asarray
-            ep_data_array = np.asarray(ep_data_list)
-            ep_data_timestamps_array = np.array(
-                event_page_doc["timestamps"][ep_data_key]
-            )
-
-            self.log.debug(
-                "event_page data_key %s has shape %s", ep_data_key, ep_data_array.shape
-            )
-
-            # retrieve information from the descriptor document
-            # already stored in the HDF5 descriptor group
-            h5_descriptor_stream_data_key_info = h5_descriptor_stream_group[
-                "data_keys"
-            ][ep_data_key]
-
             # is this the first event page document in the stream?
-            if ep_data_key not in h5_event_stream_data_group:
+            if ep_data_key not in appenders:
                 # this is the first event page document in the stream
                 # prepare to create a HDF5 dataset for this data_key
-                self.log.debug("dataset '%s' has not been created yet", ep_data_key)
-                self.log.debug("event_page data: %s", ep_data_list)
-                self.log.debug(
-                    "descriptor for '%s': %s",
-                    ep_data_key,
-                    list(h5_descriptor_stream_data_key_info.values()),
-                )
 
-                # TODO: use a databroker transform instead
-                if h5_descriptor_stream_data_key_info["dtype"][()] == "array":
+                # find the shape and dtype of one row of event page data
+                if isinstance(ep_data_list, np.ndarray):
+                    ep_row_shape = ep_data_list.shape[1:]
+                    ep_row_dtype = ep_data_list.dtype
+                elif isinstance(ep_data_list[0], np.ndarray):
+                    # for example a list of detector frames
+                    # there is no need to copy the frames to a new array
+                    ep_row_shape = ep_data_list[0].shape
+                    ep_row_dtype = ep_data_list[0].dtype
+                else:
+                    # convert the event page list of data to an array
+                    # this way there is a .shape to work with
+                    # TODO: could we get a list of things with different sizes and fail here?
+                    ep_data_array = np.asarray(ep_data_list)
+                    ep_row_shape = ep_data_array.shape[1:]
+                    ep_row_dtype = ep_data_array.dtype
+
+                if self.log.isEnabledFor(logging.DEBUG):
+                    # do not format event data or look up the descriptor
+                    # info unless it will be logged
+                    self.log.debug(
+                        "dataset '%s' has not been created yet, event_page rows have shape %s and dtype %s",
+                        ep_data_key,
+                        ep_row_shape,
+                        ep_row_dtype,
+                    )
+                    self.log.debug(
+                        "descriptor for '%s': %s",
+                        ep_data_key,
+                        self.get_descriptor(event_page_doc)["data_keys"][ep_data_key],
+                    )
+
+                h5_dtype, h5_dtype_kwargs = stream_cache["h5_dtypes"][ep_data_key]
+                is_array_data_key = h5_dtype is None
+                if is_array_data_key:
+                    # the descriptor information already stored in the HDF5
+                    # descriptor group is needed only to correct its shape
+                    # TODO: use a databroker transform instead
                     self.check_and_correct_h5_descriptor_array_shape(
-                        h5_descriptor_data_key_info=h5_descriptor_stream_data_key_info,
+                        h5_descriptor_data_key_info=stream_cache["descriptor_group"][
+                            f"data_keys/{ep_data_key}"
+                        ],
                         ep_data_key=ep_data_key,
-                        ep_data_list=ep_data_list,
+                        shape_in_descriptor=stream_cache["descriptor_shapes"][
+                            ep_data_key
+                        ],
+                        shape_in_event_page=ep_row_shape,
                     )
+                    h5_dtype = ep_row_dtype
 
+                # the dataset is created empty, rows are written
+                # one chunk at a time by a BufferedDatasetAppender
                 h5_dataset_init_kwargs = {
-                    "shape": ep_data_array.shape,
+                    "shape": (0, *ep_row_shape),
                     "name": ep_data_key,
-                    "dtype": get_h5_dtype_from_descriptor_dtype(
-                        descriptor_dtype=h5_descriptor_stream_data_key_info["dtype"][
-                            ()
-                        ],
-                        ep_data_key=ep_data_key,
-                        ep_data_list=ep_data_list,
+                    "dtype": h5_dtype,
+                    # chunks looks like the event page shape with element 0
+                    # replaced by the number of rows that fit in about chunk_nbytes
+                    # maxshape looks like the event page shape with element 0 replaced by None
+                    # for example with dtype f8 and the default 1MiB:
+                    #    event page shape  chunks           maxshape
+                    #    (3, )             (1024, )         (None, )
+                    #    (3, 4)            (1024, 4)        (None, 4)
+                    #    (3, 1024, 1024)   (1, 1024, 1024)  (None, 1024, 1024)
+                    "chunks": get_h5_dataset_chunks(
+                        row_shape=ep_row_shape,
+                        h5_dtype=h5_dtype,
+                        chunk_nbytes=self._chunk_nbytes,
                     ),
-                    # chunks looks like shape with element 0 replaced by 1
-                    # maxshape looks like shape with element 0 replaced by None
-                    # for example:
-                    #    shape     chunks    maxshape
-                    #    (3, )     (1, )     (None, )
-                    #    (3, 4)    (1, 4)    (None, 4)
-                    #    (3, 4, 5) (1, 4, 5) (None, 4, 5)
-                    "chunks": (1, *ep_data_array.shape[1:]),
-                    "maxshape": (None, *ep_data_array.shape[1:]),
+                    "maxshape": (None, *ep_row_shape),
+                    # do not update the modification time on every append
+                    "track_times": False,
+                    **h5_dtype_kwargs,
                 }
 
                 self.log.debug(
@@ -537,46 +789,65 @@ class Serializer(event_model.SingleRunDocumentRouter):
                     ep_data_key,
                     h5_dataset_init_kwargs,
                 )
-                ds = h5_event_stream_data_group.create_dataset(
+                ds = stream_cache["data_group"].create_dataset(
                     **h5_dataset_init_kwargs,
                 )
-                ds[:] = ep_data_array
+                appenders[ep_data_key] = BufferedDatasetAppender(
+                    h5_dataset=ds, expected_rows=stream_cache["expected_rows"]
+                )
 
                 # also create a timestamps dataset for this data key
+                # there is one timestamp per event regardless of the data shape
+                # so the timestamps dataset is always one-dimensional
                 h5_timestamps_dataset_init_kwargs = {
-                    "shape": (ep_data_array.shape[0],),
+                    "shape": (0,),
                     "name": ep_data_key,
                     "dtype": "f8",
-                    "chunks": (1,),
+                    "chunks": get_h5_dataset_chunks(
+                        row_shape=(), h5_dtype="f8", chunk_nbytes=self._chunk_nbytes
+                    ),
                     "maxshape": (None,),
+                    "track_times": False,
+                    # the high bytes of neighboring timestamps are nearly
+                    # always the same, shuffle+deflate is lossless, makes
+                    # timestamps datasets less than a third of the size, and
+                    # is built into every HDF5 library unlike h5py's lzf
+                    "shuffle": True,
+                    "compression": "gzip",
+                    "compression_opts": 1,
                 }
 
-                ts = h5_event_stream_data_timestamps_group.create_dataset(
+                ts = stream_cache["timestamps_group"].create_dataset(
                     **h5_timestamps_dataset_init_kwargs,
                 )
-                ts[:] = ep_data_timestamps_array
-            else:
-                # the data and timestamps datasets already exist
-                # append data to them
+                timestamps_appenders[ep_data_key] = BufferedDatasetAppender(
+                    h5_dataset=ts, expected_rows=stream_cache["expected_rows"]
+                )
 
-                ds = h5_event_stream_data_group[ep_data_key]
-                ds.resize((ds.shape[0] + ep_data_array.shape[0], *ds.shape[1:]))
-                ds[-(ep_data_array.shape[0]) :] = ep_data_array  # noqa
+            # rows are buffered and written to the h5 datasets one chunk at a time
+            appenders[ep_data_key].append(rows=ep_data_list)
+            timestamps_appenders[ep_data_key].append(rows=ep_timestamps[ep_data_key])
 
-                ts = h5_event_stream_data_timestamps_group[ep_data_key]
-                ts.resize(
-                    (ts.shape[0] + ep_data_timestamps_array.shape[0], *ts.shape[1:],)
-                )
-                ts[
-                    -(ep_data_timestamps_array.shape[0]) :  # noqa
-                ] = ep_data_timestamps_array
+    def flush(self):
+        """
+        Write event data and timestamps buffered by event_page() to the h5 file.
+        """
+        for stream_cache in self._stream_cache.values():
+            for appender in stream_cache["appenders"].values():
+                appender.flush()
+            for timestamps_appender in stream_cache["timestamps_appenders"].values():
+                timestamps_appender.flush()
 
     def stop(self, doc):
         super().stop(doc)
 
+        # write the last partial chunk of each event dataset
+        self.flush()
+
         _copy_metadata_to_h5_datasets(
             a_mapping=doc,
-            h5_group=self._h5_output_file[self.bluesky_h5_group_name]["stop"],
+            h5_group=self._h5_stop_group,
+            scalars_as_attrs=self._scalar_metadata_as_attrs,
         )
 
         # all bluesky documents have been serialized
@@ -585,8 +856,9 @@ class Serializer(event_model.SingleRunDocumentRouter):
         start_doc = self.get_start()
 
         if "md" in start_doc and "techniques" in start_doc["md"]:
-            techniques_md = copy.deepcopy(start_doc["md"]["techniques"])
-            for technique_info in techniques_md:
+            # _copy_nexus_md_to_nexus_h5 does not modify the metadata
+            # so there is no need to copy it
+            for technique_info in start_doc["md"]["techniques"]:
                 technique = technique_info["technique"]
                 # "version" is mandatory
                 technique_schema_version = technique_info["version"]
@@ -603,7 +875,11 @@ class Serializer(event_model.SingleRunDocumentRouter):
         self.close()
 
     def check_and_correct_h5_descriptor_array_shape(
-        self, h5_descriptor_data_key_info, ep_data_key, ep_data_list
+        self,
+        h5_descriptor_data_key_info,
+        ep_data_key,
+        shape_in_descriptor,
+        shape_in_event_page,
     ):
         # check for disagreement between the shape specified by the descriptor
         # and the shape of the filled event_page array
@@ -612,8 +888,8 @@ class Serializer(event_model.SingleRunDocumentRouter):
 
         # in the case of disagreement the shape in the descriptor might look like [1024 1026 0]
         # and the shape of the filled event_page array looks like (1026, 1024)
-        shape_in_descriptor = tuple(h5_descriptor_data_key_info["shape"][()])
-        shape_in_event_page = ep_data_list[0].shape
+        # shape_in_descriptor is a tuple taken from the descriptor document
+        # shape_in_event_page is the shape of one event's array
         self.log.debug(
             "data key %s: descriptor shape: %s event_page shape: %s",
             ep_data_key,
@@ -624,37 +900,86 @@ class Serializer(event_model.SingleRunDocumentRouter):
             # descriptor and event_page array shapes are equivalent
             # no correction necessary
             pass
-        elif tuple(reversed(shape_in_descriptor))[1:] == shape_in_event_page:
+        elif shape_in_descriptor[-2::-1] == shape_in_event_page:
             # for example,
             #     shape_in_descriptor = (1024, 1026, 0)
             #     shape_in_event_page = (1026, 1024)
             # will evaluate True:
-            #     tuple(reverse((1024, 1026, 0))[1:] == (1026, 1024)
+            #     (1024, 1026, 0)[-2::-1] == (1026, 1024)
+            # the slice reverses the descriptor shape without its last element
             # we need to correct the shape copied from the descriptor document
             self.log.warning(
                 "reversing shape %s of data_key %s", shape_in_descriptor, ep_data_key,
             )
             # update the h5 descriptor shape
-            h5_descriptor_data_key_info["shape"][()] = tuple(
-                reversed(shape_in_descriptor)
-            )
+            h5_descriptor_data_key_info["shape"][()] = shape_in_descriptor[::-1]
         else:
             raise ValueError(
                 f"descriptor and event_page array shapes for data_key {ep_data_key} can not be reconciled"
             )
 
 
+def get_data_key_layouts(data_keys):
+    """
+    Return the descriptor fields that determine the h5 dataset of each data_key.
+
+    Parameters
+    ----------
+    data_keys: dict
+        the "data_keys" of a descriptor document
+
+    Returns
+    -------
+    dict mapping each data_key to a tuple of its dtype, shape, and dtype_numpy
+    """
+    return {
+        data_key: (
+            data_key_info["dtype"],
+            tuple(data_key_info["shape"]),
+            data_key_info.get("dtype_numpy", None),
+        )
+        for data_key, data_key_info in data_keys.items()
+    }
+
+
 _descriptor_dtype_to_h5_dtype = {
     "string": h5py.string_dtype(),
     "number": "f8",
-    "integer": "i4",
+    # python integers are 64 bits
+    "integer": "i8",
+    "boolean": "?",
+}
+
+# fixed-length string rows are mostly NUL padding, byte-shuffled deflate
+# squeezes it out with a filter built into every HDF5 library
+_fixed_length_string_compression_kwargs = {
+    "shuffle": True,
+    "compression": "gzip",
+    "compression_opts": 1,
 }
 
 
-def get_h5_dtype_from_descriptor_dtype(descriptor_dtype, ep_data_key, ep_data_list):
+def get_h5_dtype_from_descriptor_dtype(
+    descriptor_dtype, ep_data_key, ep_data_list, dtype_numpy=None
+):
     if descriptor_dtype == "array":
         # get the dtype from the first array in ep_data_list
         h5_dtype = ep_data_list[0].dtype
+    elif (
+        descriptor_dtype == "string"
+        and dtype_numpy is not None
+        and np.dtype(dtype_numpy).kind in "US"
+        and np.dtype(dtype_numpy).itemsize > 0
+    ):
+        # the descriptor gives a maximum string length, for example "<U40"
+        # other numpy dtypes such as "|O" give no length and strings for
+        # them are stored as variable-length strings
+        # store fixed-length strings inside the dataset chunks rather than
+        # variable-length strings on the heap, allowing 4 bytes per character
+        # (numpy "U" itemsize) since UTF-8 uses at most 4 bytes per character
+        h5_dtype = h5py.string_dtype(
+            encoding="utf-8", length=np.dtype(dtype_numpy).itemsize
+        )
     elif descriptor_dtype in _descriptor_dtype_to_h5_dtype:
         h5_dtype = _descriptor_dtype_to_h5_dtype[descriptor_dtype]
     else:
@@ -665,44 +990,244 @@ def get_h5_dtype_from_descriptor_dtype(descriptor_dtype, ep_data_key, ep_data_li
     return h5_dtype
 
 
-def get_h5_dataset_shape_from_descriptor_shape(
-    descriptor_shape, ep_data_key, ep_data_list
-):
+def encode_fixed_length_strings(strings, h5_dtype):
     """
-    Return the initial shape of the h5 dataset corresponding to the specified data_key.
-    Initially the dataset will have length 0. It will be resized when data is appended.
+    Encode a sequence of str as UTF-8 for a fixed-length string h5 dataset.
 
-    The descriptor shape will be either an empty list or a list of integers.
-
-    The return will be a sequence of integers beginning with 0. For example:
-        descriptor shape [] -> h5 dataset shape (1, )
-        descriptor shape [0, 100, 100] -> h5 dataset (1, 100, 100)
+    h5py does not convert str to fixed-length strings. A string longer than
+    the h5 dtype length in UTF-8 raises ValueError rather than being truncated,
+    possibly in the middle of a multi-byte character.
 
     Parameters
     ----------
-    descriptor_shape: Sequence of int, possibly empty
-        the "shape" field for ep_data_key taken from a descriptor document
-    ep_data_key: str
-        bluesky data_key
-    ep_data_list: list
-        event_page list of data values: int, str, float, or array for ep_data_key
+    strings: Sequence of str
+        for example an event page list of str
+    h5_dtype: numpy dtype
+        a fixed-length string dtype from h5py.string_dtype(encoding="utf-8", length=...)
 
     Returns
     -------
-    tuple, the initial shape of the h5 dataset corresponding to ep_data_key, the first element of which
-    will be 0 to indicate the dataset should be created empty
+    numpy.ndarray with dtype h5_dtype
     """
-    print(f"descriptor_shape: {descriptor_shape}")
-    if not isinstance(descriptor_shape, list):
+    encoded_strings = np.char.encode(np.asarray(strings, dtype=str), "utf-8")
+    # the encoded array is as wide as the longest encoded string
+    if encoded_strings.dtype.itemsize > h5_dtype.itemsize:
+        too_long_strings = [
+            s for s in encoded_strings.flat if len(s) > h5_dtype.itemsize
+        ]
         raise ValueError(
-            f"descriptor_shape must be a list, but is a {type(descriptor_shape)}"
+            f"{len(too_long_strings)} string(s) longer than {h5_dtype.itemsize} bytes in UTF-8, "
+            f"the first is {too_long_strings[0].decode('utf-8')!r}"
         )
-    elif len(descriptor_shape) == 0:
-        # descriptor_shape is []
-        return (1,)
-    else:
-        if descriptor_shape[0] != 0:
-            raise ValueError(
-                f"descriptor shape for data_key {ep_data_key} should start with 0 but is {descriptor_shape}"
+    return encoded_strings.astype(h5_dtype)
+
+
+def get_h5_dataset_chunks(row_shape, h5_dtype, chunk_nbytes=2 ** 20, max_chunk_rows=1024):
+    """
+    Return a chunk shape for an extendable h5 dataset of rows with shape row_shape.
+
+    The first element of the chunk shape is the number of rows that fit in
+    about chunk_nbytes, but at least 1 and at most max_chunk_rows. The limit
+    on rows keeps small datasets small, since HDF5 allocates whole chunks.
+    For example, with dtype f8:
+        row_shape ()           -> chunks (1024, )
+        row_shape (1024, )     -> chunks (128, 1024)
+        row_shape (1024, 1024) -> chunks (1, 1024, 1024)
+
+    Parameters
+    ----------
+    row_shape: Sequence of int, possibly empty
+        shape of one row of the dataset, that is the dataset shape without the first element
+    h5_dtype: numpy dtype or anything numpy.dtype accepts
+        dtype of the dataset
+    chunk_nbytes: int
+        target number of bytes per chunk
+    max_chunk_rows: int
+        largest allowed number of rows per chunk
+
+    Returns
+    -------
+    tuple, chunk shape beginning with the number of rows per chunk
+    """
+    row_nbytes = np.dtype(h5_dtype).itemsize * int(np.prod(row_shape))
+    chunk_rows = max(1, min(max_chunk_rows, chunk_nbytes // max(1, row_nbytes)))
+    return (chunk_rows, *row_shape)
+
+
+class BufferedDatasetAppender:
+    """
+    Append rows to an extendable h5 dataset one chunk at a time.
+
+    Rows are copied into a buffer with the chunk shape of the dataset and the
+    buffer is written when it is full. Every write then covers exactly one
+    chunk, so HDF5 never reads back, decompresses, and compresses a partially
+    written chunk again as event pages arrive. Rows left in the buffer are
+    written by flush().
+
+    The dataset is resized to at least double its length when a write does
+    not fit, rather than once for every write. Until flush() is called the
+    dataset may be longer than the number of rows appended.
+
+    Parameters
+    ----------
+    h5_dataset: h5py.Dataset
+        chunked dataset with maxshape (None, ...)
+    expected_rows: int, optional
+        if the number of rows to be appended is known, for example from the
+        RunStart document "num_points", the dataset is resized to this length
+        with the first write
+    """
+
+    def __init__(self, h5_dataset, expected_rows=None):
+        self.h5_dataset = h5_dataset
+        self._expected_rows = expected_rows
+        self._buffer = get_staging_buffer(
+            shape=h5_dataset.chunks, dtype=h5_dataset.dtype
+        )
+        self._buffered_rows = 0
+        # rows written to the dataset, the dataset may be longer
+        self._written_rows = h5_dataset.shape[0]
+        # whole chunks of a dataset without filters can be written as they
+        # are in memory, bypassing the HDF5 filter pipeline and chunk cache,
+        # but variable-length strings in memory are pointers
+        self._write_direct_chunks = (
+            h5_dataset.id.get_create_plist().get_nfilters() == 0
+            and h5_dataset.dtype.kind != "O"
+        )
+
+    def append(self, rows):
+        """
+        Copy rows into the buffer, writing the buffer each time it is full.
+
+        Whole chunks of a large array of rows are written without copying
+        them into the buffer, with one resize and one write.
+
+        Parameters
+        ----------
+        rows: Sequence or numpy.ndarray
+            each row has shape h5_dataset.shape[1:], for example an event page list of data
+        """
+        buffer_rows = self._buffer.shape[0]
+        # copy a sequence of arrays, for example detector frames, one row at
+        # a time rather than converting it to a new array for each event page
+        copy_row_by_row = self._buffer.ndim > 1 and not isinstance(rows, np.ndarray)
+        # an array with the dataset dtype can be written directly,
+        # object arrays may lack the h5py string dtype metadata
+        write_whole_chunks = (
+            isinstance(rows, np.ndarray)
+            and rows.dtype == self._buffer.dtype
+            and rows.dtype.kind != "O"
+            and rows.flags.c_contiguous
+        )
+        n_rows = len(rows)
+        first_row = 0
+        while first_row < n_rows:
+            if (
+                write_whole_chunks
+                and self._buffered_rows == 0
+                and n_rows - first_row >= buffer_rows
+            ):
+                whole_chunk_rows = (n_rows - first_row) // buffer_rows * buffer_rows
+                self._write_rows(rows, first_row=first_row, n_rows=whole_chunk_rows)
+                first_row += whole_chunk_rows
+                continue
+            batch_rows = min(buffer_rows - self._buffered_rows, n_rows - first_row)
+            # most event pages hold one event, assigning a single row is
+            # much faster than converting a one-element slice to an array
+            if copy_row_by_row or batch_rows == 1:
+                for i in range(batch_rows):
+                    self._buffer[self._buffered_rows + i] = rows[first_row + i]
+            else:
+                self._buffer[
+                    self._buffered_rows : self._buffered_rows + batch_rows  # noqa
+                ] = rows[first_row : first_row + batch_rows]  # noqa
+            self._buffered_rows += batch_rows
+            first_row += batch_rows
+            if self._buffered_rows == buffer_rows:
+                self._write_buffer()
+
+    def flush(self):
+        """
+        Write the buffered rows and shrink the dataset to the number of rows appended.
+        """
+        self._write_buffer()
+        if self.h5_dataset.shape[0] != self._written_rows:
+            self.h5_dataset.resize((self._written_rows, *self.h5_dataset.shape[1:]))
+
+    def _write_buffer(self):
+        """
+        Write the buffered rows after the rows already written.
+        """
+        if self._buffered_rows > 0:
+            self._write_rows(self._buffer, first_row=0, n_rows=self._buffered_rows)
+            self._buffered_rows = 0
+
+    def _write_rows(self, an_array, first_row, n_rows):
+        """
+        Write n_rows rows of an_array, starting at first_row, after the rows already written.
+        """
+        new_written_rows = self._written_rows + n_rows
+        h5_dataset_rows = self.h5_dataset.shape[0]
+        if new_written_rows > h5_dataset_rows:
+            # chunks are allocated when they are written so
+            # the unwritten end of the dataset takes no space
+            new_h5_dataset_rows = max(new_written_rows, 2 * h5_dataset_rows)
+            if self._expected_rows is not None:
+                new_h5_dataset_rows = max(new_h5_dataset_rows, self._expected_rows)
+            self.h5_dataset.resize((new_h5_dataset_rows, *self.h5_dataset.shape[1:]))
+        chunk_rows = self._buffer.shape[0]
+        if (
+            self._write_direct_chunks
+            and n_rows % chunk_rows == 0
+            and self._written_rows % chunk_rows == 0
+        ):
+            # an_array is C-contiguous with the dataset dtype so each
+            # chunk of rows is exactly the bytes HDF5 would store
+            chunk_offset_tail = (0,) * (an_array.ndim - 1)
+            for chunk_first_row in range(first_row, first_row + n_rows, chunk_rows):
+                dataset_row = self._written_rows + chunk_first_row - first_row
+                self.h5_dataset.id.write_direct_chunk(
+                    (dataset_row, *chunk_offset_tail),
+                    an_array[chunk_first_row : chunk_first_row + chunk_rows],  # noqa
+                )
+        else:
+            # an_array has the dataset dtype so write_direct
+            # skips h5py's type conversion and selection machinery
+            self.h5_dataset.write_direct(
+                an_array,
+                source_sel=np.s_[first_row : first_row + n_rows],  # noqa
+                dest_sel=np.s_[self._written_rows : new_written_rows],  # noqa
             )
-        return (1, *descriptor_shape[1:])
+        self._written_rows = new_written_rows
+
+
+# buffers at least this large are backed by transparent huge pages if possible
+_hugepage_staging_buffer_nbytes = 2 * 2 ** 20
+
+
+def get_staging_buffer(shape, dtype):
+    """
+    Return an uninitialized C-contiguous array to be reused for writing rows.
+
+    On platforms that support it, large buffers are allocated with mmap and
+    marked with MADV_HUGEPAGE to reduce TLB misses when copying large frames.
+
+    Parameters
+    ----------
+    shape: tuple of int
+        shape of the buffer
+    dtype: numpy dtype or anything numpy.dtype accepts
+        dtype of the buffer
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    dtype = np.dtype(dtype)
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    if nbytes >= _hugepage_staging_buffer_nbytes and hasattr(mmap, "MADV_HUGEPAGE"):
+        buffer = mmap.mmap(-1, nbytes)
+        buffer.madvise(mmap.MADV_HUGEPAGE)
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    else:
+        return np.empty(shape, dtype=dtype)
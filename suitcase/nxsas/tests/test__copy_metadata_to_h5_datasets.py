@@ -1,3 +1,5 @@
+import json
+
 from suitcase.nxsas import _copy_metadata_to_h5_datasets
 
 
@@ -34,3 +36,43 @@ def test_str_tuple(h5_context):
         # print("@@@ detectors dataset:")
         # print(tmp_h5_file["detectors"])
         assert all(tmp_h5_file["detectors"][()] == ("Synced", "en_energy"))
+
+
+def test_scalars_as_attrs(h5_context):
+    with h5_context() as tmp_h5_file:
+        _copy_metadata_to_h5_datasets(
+            a_mapping={
+                "uid": "5720b93f-2f5d-4ace-8ace-2efb669fc38f",
+                "scan_id": 1,
+                "detectors": ["Synced", "en_energy"],
+                "hints": {"dimensions": "time"},
+            },
+            h5_group=tmp_h5_file,
+            scalars_as_attrs=True,
+        )
+
+        assert "uid" not in tmp_h5_file
+        assert tmp_h5_file.attrs["uid"] == "5720b93f-2f5d-4ace-8ace-2efb669fc38f"
+        assert tmp_h5_file.attrs["scan_id"] == 1
+        assert tmp_h5_file["hints"].attrs["dimensions"] == "time"
+        # non-scalar values are still datasets
+        assert list(tmp_h5_file["detectors"].asstr()[()]) == ["Synced", "en_energy"]
+
+
+def test_scalars_as_attrs_fall_back_to_datasets(h5_context):
+    with h5_context() as tmp_h5_file:
+        _copy_metadata_to_h5_datasets(
+            a_mapping={
+                "large_int": 2 ** 70,
+                "nul_str": "a\x00b",
+                "nul_bytes": b"a\x00b",
+            },
+            h5_group=tmp_h5_file,
+            scalars_as_attrs=True,
+        )
+
+        # values that can not be h5 attributes are stored as datasets
+        assert len(tmp_h5_file.attrs) == 0
+        assert json.loads(tmp_h5_file["large_int"].asstr()[()]) == 2 ** 70
+        assert json.loads(tmp_h5_file["nul_str"].asstr()[()]) == "a\x00b"
+        assert tmp_h5_file["nul_bytes"][()].tobytes() == b"a\x00b"
@@ -0,0 +1,93 @@
+import h5py
+import numpy as np
+
+from suitcase.nxsas import BufferedDatasetAppender
+
+
+def test_buffered_dataset_appender(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as h5f:
+        scalar_dataset = h5f.create_dataset(
+            "scalars", shape=(0,), dtype="f8", chunks=(4,), maxshape=(None,)
+        )
+        array_dataset = h5f.create_dataset(
+            "arrays", shape=(0, 2), dtype="i8", chunks=(4, 2), maxshape=(None, 2)
+        )
+        scalar_appender = BufferedDatasetAppender(h5_dataset=scalar_dataset)
+        array_appender = BufferedDatasetAppender(h5_dataset=array_dataset)
+
+        # rows are written only when a whole chunk has been buffered
+        scalar_appender.append(rows=[0.0, 1.0, 2.0])
+        array_appender.append(rows=[np.array([0, 1]), np.array([2, 3])])
+        assert scalar_dataset.shape == (0,)
+        assert array_dataset.shape == (0, 2)
+
+        scalar_appender.append(rows=[3.0, 4.0])
+        array_appender.append(rows=np.arange(4, 14).reshape((5, 2)))
+        assert scalar_dataset.shape == (4,)
+        assert array_dataset.shape == (4, 2)
+
+        # flush writes the partial chunk
+        scalar_appender.flush()
+        array_appender.flush()
+        assert np.array_equal(scalar_dataset[()], [0.0, 1.0, 2.0, 3.0, 4.0])
+        assert np.array_equal(array_dataset[()], np.arange(14).reshape((7, 2)))
+
+        # nothing is buffered after flush
+        scalar_appender.flush()
+        assert scalar_dataset.shape == (5,)
+
+
+def test_buffered_dataset_appender_whole_chunks(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as h5f:
+        h5_dataset = h5f.create_dataset(
+            "arrays", shape=(0, 2), dtype="i8", chunks=(4, 2), maxshape=(None, 2)
+        )
+        appender = BufferedDatasetAppender(h5_dataset=h5_dataset)
+
+        # whole chunks of a large array are written immediately
+        appender.append(rows=np.arange(22).reshape((11, 2)))
+        assert h5_dataset.shape == (8, 2)
+
+        appender.append(rows=np.arange(22, 34).reshape((6, 2)))
+        # the dataset length is doubled rather than increased by one chunk
+        assert h5_dataset.shape == (16, 2)
+
+        # flush trims the dataset to the rows appended
+        appender.flush()
+        assert h5_dataset.shape == (17, 2)
+        assert np.array_equal(h5_dataset[()], np.arange(34).reshape((17, 2)))
+
+
+def test_buffered_dataset_appender_filtered(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as h5f:
+        h5_dataset = h5f.create_dataset(
+            "arrays",
+            shape=(0, 2),
+            dtype="i8",
+            chunks=(4, 2),
+            maxshape=(None, 2),
+            compression="gzip",
+        )
+        appender = BufferedDatasetAppender(h5_dataset=h5_dataset)
+
+        appender.append(rows=np.arange(22).reshape((11, 2)))
+        appender.append(rows=[np.array([22, 23]), np.array([24, 25])])
+        appender.flush()
+        assert np.array_equal(h5_dataset[()], np.arange(26).reshape((13, 2)))
+
+
+def test_buffered_dataset_appender_expected_rows(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as h5f:
+        h5_dataset = h5f.create_dataset(
+            "scalars", shape=(0,), dtype="f8", chunks=(4,), maxshape=(None,)
+        )
+        appender = BufferedDatasetAppender(h5_dataset=h5_dataset, expected_rows=10)
+
+        # the first write resizes the dataset to the expected length
+        appender.append(rows=np.arange(4.0))
+        assert h5_dataset.shape == (10,)
+
+        # fewer rows than expected
+        appender.append(rows=np.arange(4.0, 6.0))
+        appender.flush()
+        assert np.array_equal(h5_dataset[()], np.arange(6.0))
@@ -1,5 +1,9 @@
+import uuid
+
 import h5py
+import hdf5plugin
 import numpy as np
+import pytest
 
 import event_model
 
@@ -17,6 +21,7 @@ def export_h5_file(
     desc_data_keys,
     event_data_and_timestamps_list=None,
     event_page_data_and_timestamps_list=None,
+    **serializer_kwargs,
 ):
     (
         start_doc,
@@ -49,12 +54,19 @@ def export_h5_file(
     stop_doc = compose_stop()
     document_list.append(("stop", stop_doc))
 
-    artifacts = nxsas.export(gen=document_list, directory=output_directory,)
+    artifacts = nxsas.export(
+        gen=document_list, directory=output_directory, **serializer_kwargs
+    )
 
     assert len(artifacts["stream_data"]) == 1
     return artifacts["stream_data"][0]
 
 
+def _filter_ids(h5_dataset):
+    dcpl = h5_dataset.id.get_create_plist()
+    return [dcpl.get_filter(i)[0] for i in range(dcpl.get_nfilters())]
+
+
 def test_number_dataset_from_event_page(tmp_path):
     event_page_data_and_timestamps_list = [
         {
@@ -97,6 +109,74 @@ def test_number_dataset_from_event_page(tmp_path):
         )
 
 
+def test_chunk_nbytes(tmp_path):
+    event_page_data_and_timestamps_list = [
+        {
+            "seq_num": [1, 2, 3],
+            "data": {"en_energy": [1.0, 2.0, 3.0]},
+            "timestamps": {"en_energy": [100.0, 200.0, 300.0]},
+        },
+    ]
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path,
+        desc_data_keys={
+            "en_energy": {
+                "source": "PY:en_energy.position",
+                "dtype": "number",
+                "shape": [],
+                "units": "",
+                "object_name": "en",
+            },
+        },
+        event_page_data_and_timestamps_list=event_page_data_and_timestamps_list,
+        chunk_nbytes=16,
+    )
+
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        # two f8 values per chunk
+        assert h5_events_primary["data"]["en_energy"].chunks == (2,)
+        assert h5_events_primary["timestamps"]["en_energy"].chunks == (2,)
+        assert np.array_equal(
+            h5_events_primary["data"]["en_energy"][()], [1.0, 2.0, 3.0]
+        )
+
+
+def test_data_key_compression(tmp_path):
+    event_page_data_and_timestamps_list = [
+        {
+            "seq_num": [1, 2],
+            "data": {"en_energy": [1.0, 2.0], "en_current": [3.0, 4.0]},
+            "timestamps": {"en_energy": [100.0, 200.0], "en_current": [100.0, 200.0]},
+        },
+    ]
+    desc_data_key_info = {
+        "source": "PY:en_energy.position",
+        "dtype": "number",
+        "shape": [],
+        "units": "",
+        "object_name": "en",
+    }
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path,
+        desc_data_keys={
+            "en_energy": desc_data_key_info,
+            "en_current": desc_data_key_info,
+        },
+        event_page_data_and_timestamps_list=event_page_data_and_timestamps_list,
+        data_key_compression={"en_energy": {"compression": "lzf", "shuffle": True}},
+    )
+
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_events_primary_data = h["bluesky"]["events"]["primary"]["data"]
+        assert _filter_ids(h5_events_primary_data["en_energy"]) == [
+            h5py.h5z.FILTER_SHUFFLE,
+            h5py.h5z.FILTER_LZF,
+        ]
+        assert _filter_ids(h5_events_primary_data["en_current"]) == []
+        assert np.array_equal(h5_events_primary_data["en_energy"][()], [1.0, 2.0])
+
+
 def test_number_dataset_from_events(tmp_path):
     event_data_and_timestamps_list = [
         {
@@ -143,6 +223,133 @@ def test_number_dataset_from_events(tmp_path):
         )
 
 
+def test_repeated_stream_descriptor(tmp_path):
+    (
+        start_doc,
+        compose_descriptor,
+        compose_resource,
+        compose_stop,
+    ) = event_model.compose_run(metadata={"md": {"techniques": []}})
+    desc_data_keys = {
+        "en_energy": {
+            "source": "PY:en_energy.position",
+            "dtype": "number",
+            "shape": [],
+            "object_name": "en",
+        },
+    }
+    document_list = [("start", start_doc)]
+    # two descriptors for the "primary" stream
+    for energy in (1.0, 2.0):
+        descriptor_doc, compose_event, _ = compose_descriptor(
+            data_keys=desc_data_keys, name="primary"
+        )
+        document_list.append(("descriptor", descriptor_doc))
+        document_list.append(
+            (
+                "event",
+                compose_event(
+                    data={"en_energy": energy}, timestamps={"en_energy": energy}
+                ),
+            )
+        )
+    document_list.append(("stop", compose_stop()))
+
+    artifacts = nxsas.export(gen=document_list, directory=tmp_path)
+
+    with h5py.File(artifacts["stream_data"][0], "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        assert np.all(h5_events_primary["data"]["en_energy"][()] == [1.0, 2.0])
+        assert np.all(h5_events_primary["timestamps"]["en_energy"][()] == [1.0, 2.0])
+
+
+def test_repeated_stream_descriptor_with_new_data_key(tmp_path):
+    (
+        start_doc,
+        compose_descriptor,
+        compose_resource,
+        compose_stop,
+    ) = event_model.compose_run(metadata={"md": {"techniques": []}})
+    desc_data_keys = {
+        "en_energy": {
+            "source": "PY:en_energy.position",
+            "dtype": "number",
+            "shape": [],
+            "object_name": "en",
+        },
+    }
+    first_descriptor_doc, _, _ = compose_descriptor(
+        data_keys=desc_data_keys, name="primary"
+    )
+    # the second "primary" descriptor adds a data_key
+    # compose_descriptor does not allow this so build it by hand
+    second_descriptor_doc = {
+        **first_descriptor_doc,
+        "uid": str(uuid.uuid4()),
+        "data_keys": {
+            **desc_data_keys,
+            "en_polarization": {
+                "source": "PY:en_polarization.position",
+                "dtype": "number",
+                "shape": [],
+                "object_name": "en",
+            },
+        },
+    }
+
+    with nxsas.Serializer(directory=tmp_path) as serializer:
+        serializer("start", start_doc)
+        serializer("descriptor", first_descriptor_doc)
+        with pytest.raises(ValueError, match="en_polarization"):
+            serializer("descriptor", second_descriptor_doc)
+
+
+def test_repeated_stream_descriptor_with_changed_data_key(tmp_path):
+    (
+        start_doc,
+        compose_descriptor,
+        compose_resource,
+        compose_stop,
+    ) = event_model.compose_run(metadata={"md": {"techniques": []}})
+    desc_data_keys = {
+        "en_energy": {
+            "source": "PY:en_energy.position",
+            "dtype": "number",
+            "shape": [],
+            "object_name": "en",
+        },
+        "en_monoen_grating_plim_desc": {
+            "source": "PV:XF:07ID1-OP{Mono:PGM1-Ax:GrtP}Mtr_PLIM_STS.DESC",
+            "dtype": "string",
+            "dtype_numpy": "<U40",
+            "shape": [],
+            "object_name": "en",
+        },
+    }
+    first_descriptor_doc, _, _ = compose_descriptor(
+        data_keys=desc_data_keys, name="primary"
+    )
+    # the second "primary" descriptor has the same data_keys but a longer
+    # string, the changed units of en_energy alone would be accepted
+    second_descriptor_doc = {
+        **first_descriptor_doc,
+        "uid": str(uuid.uuid4()),
+        "data_keys": {
+            "en_energy": {**desc_data_keys["en_energy"], "units": "eV"},
+            "en_monoen_grating_plim_desc": {
+                **desc_data_keys["en_monoen_grating_plim_desc"],
+                "dtype_numpy": "<U80",
+            },
+        },
+    }
+
+    with nxsas.Serializer(directory=tmp_path) as serializer:
+        serializer("start", start_doc)
+        serializer("descriptor", first_descriptor_doc)
+        with pytest.raises(ValueError, match=r"\['en_monoen_grating_plim_desc'\]"):
+            serializer("descriptor", second_descriptor_doc)
+
+
 def test_str_dataset(tmp_path):
     event_page_info = [
         {
@@ -179,6 +386,150 @@ def test_str_dataset(tmp_path):
         )
 
 
+def test_fixed_length_str_dataset(tmp_path):
+    event_page_info = [
+        {
+            "seq_num": [1, 2],
+            "data": {"en_monoen_grating_plim_desc": ["Positive End Limit Set", "Ø"]},
+            "timestamps": {"en_monoen_grating_plim_desc": [1573882935.047036, 1573882936.0]},
+        },
+        {
+            "seq_num": [3],
+            "data": {"en_monoen_grating_plim_desc": ["Limit"]},
+            "timestamps": {"en_monoen_grating_plim_desc": [1573882937.0]},
+        },
+    ]
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path,
+        desc_data_keys={
+            "en_monoen_grating_plim_desc": {
+                "source": "PV:XF:07ID1-OP{Mono:PGM1-Ax:GrtP}Mtr_PLIM_STS.DESC",
+                "dtype": "string",
+                "dtype_numpy": "<U40",
+                "shape": [],
+                "object_name": "en",
+            },
+        },
+        event_page_data_and_timestamps_list=event_page_info,
+    )
+
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_dataset = h["bluesky"]["events"]["primary"]["data"]["en_monoen_grating_plim_desc"]
+        # 40 characters of at most 4 UTF-8 bytes each
+        string_info = h5py.check_string_dtype(h5_dataset.dtype)
+        assert string_info.encoding == "utf-8"
+        assert string_info.length == 160
+        assert _filter_ids(h5_dataset) == [
+            h5py.h5z.FILTER_SHUFFLE,
+            h5py.h5z.FILTER_DEFLATE,
+        ]
+        assert [
+            s.decode("utf-8") for s in h5_dataset[()]
+        ] == ["Positive End Limit Set", "Ø", "Limit"]
+
+
+def test_too_long_fixed_length_str_leaves_rows_aligned(tmp_path):
+    (
+        start_doc,
+        compose_descriptor,
+        compose_resource,
+        compose_stop,
+    ) = event_model.compose_run(metadata={"md": {"techniques": []}})
+    descriptor_doc, _, compose_event_page = compose_descriptor(
+        data_keys={
+            "en_energy": {
+                "source": "PY:en_energy.position",
+                "dtype": "number",
+                "shape": [],
+                "object_name": "en",
+            },
+            "en_monoen_grating_plim_desc": {
+                "source": "PV:XF:07ID1-OP{Mono:PGM1-Ax:GrtP}Mtr_PLIM_STS.DESC",
+                "dtype": "string",
+                "dtype_numpy": "<U1",
+                "shape": [],
+                "object_name": "en",
+            },
+        },
+        name="primary",
+    )
+
+    with nxsas.Serializer(directory=tmp_path) as serializer:
+        serializer("start", start_doc)
+        serializer("descriptor", descriptor_doc)
+        serializer(
+            "event_page",
+            compose_event_page(
+                data={"en_energy": [1.0], "en_monoen_grating_plim_desc": ["ok"]},
+                timestamps={"en_energy": [1.0], "en_monoen_grating_plim_desc": [1.0]},
+                seq_num=[1],
+            ),
+        )
+        with pytest.raises(ValueError, match="en_monoen_grating_plim_desc"):
+            serializer(
+                "event_page",
+                compose_event_page(
+                    data={
+                        "en_energy": [2.0],
+                        "en_monoen_grating_plim_desc": ["too long"],
+                    },
+                    timestamps={
+                        "en_energy": [2.0],
+                        "en_monoen_grating_plim_desc": [2.0],
+                    },
+                    seq_num=[2],
+                ),
+            )
+
+    with h5py.File(serializer.artifacts["stream_data"][0], "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        # the rejected page was not written for either data_key
+        for data_key in ("en_energy", "en_monoen_grating_plim_desc"):
+            assert h5_events_primary["data"][data_key].shape == (1,)
+            assert h5_events_primary["timestamps"][data_key].shape == (1,)
+
+
+def test_object_dtype_numpy_str_dataset(tmp_path):
+    # "|O8" is not a string dtype and gives no string length
+    long_string = "a string much longer than the 8 byte itemsize of |O8"
+    event_page_info = [
+        {
+            "seq_num": [1],
+            "data": {"en_monoen_grating_plim_desc": [long_string]},
+            "timestamps": {"en_monoen_grating_plim_desc": [1573882935.047036]},
+        },
+    ]
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path,
+        desc_data_keys={
+            "en_monoen_grating_plim_desc": {
+                "source": "PV:XF:07ID1-OP{Mono:PGM1-Ax:GrtP}Mtr_PLIM_STS.DESC",
+                "dtype": "string",
+                "dtype_numpy": "|O8",
+                "shape": [],
+                "object_name": "en",
+            },
+        },
+        event_page_data_and_timestamps_list=event_page_info,
+    )
+
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_dataset = h["bluesky"]["events"]["primary"]["data"]["en_monoen_grating_plim_desc"]
+        assert h5py.check_string_dtype(h5_dataset.dtype).length is None
+        assert list(h5_dataset.asstr()[()]) == [long_string]
+
+
+def test_encode_fixed_length_strings():
+    h5_dtype = h5py.string_dtype(encoding="utf-8", length=4)
+    assert list(nxsas.encode_fixed_length_strings(["aaaa", "Ø"], h5_dtype)) == [
+        b"aaaa",
+        "Ø".encode("utf-8"),
+    ]
+    # do not cut a 4-byte UTF-8 character after its first byte
+    with pytest.raises(ValueError, match="longer than 4 bytes"):
+        nxsas.encode_fixed_length_strings(["aaa\U0001F600"], h5_dtype)
+
+
 def test_integer_dataset(tmp_path):
     event_page_info = [
         {
@@ -205,6 +556,7 @@ def test_integer_dataset(tmp_path):
 
     with h5py.File(h5_output_filepath, "r") as h:
         h5_events_primary = h["bluesky"]["events"]["primary"]
+        assert h5_events_primary["data"]["en_monoen_grating_encoder"].dtype == np.int64
         assert (
             h5_events_primary["data"]["en_monoen_grating_encoder"][()]
             == event_page_info[0]["data"]["en_monoen_grating_encoder"]
@@ -215,6 +567,36 @@ def test_integer_dataset(tmp_path):
         )
 
 
+def test_boolean_dataset(tmp_path):
+    event_page_info = [
+        {
+            "seq_num": [1, 2],
+            "data": {"en_monoen_grating_moving": [True, False]},
+            "timestamps": {"en_monoen_grating_moving": [1573882951.510888, 1573882952.0]},
+        },
+    ]
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path,
+        desc_data_keys={
+            "en_monoen_grating_moving": {
+                "source": "PV:XF:07ID1-OP{Mono:PGM1-Ax:GrtP}Mtr.MOVN",
+                "dtype": "boolean",
+                "shape": [],
+                "object_name": "en",
+            },
+        },
+        event_page_data_and_timestamps_list=event_page_info,
+    )
+
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        assert h5_events_primary["data"]["en_monoen_grating_moving"].dtype == np.bool_
+        assert np.all(
+            h5_events_primary["data"]["en_monoen_grating_moving"][()]
+            == event_page_info[0]["data"]["en_monoen_grating_moving"]
+        )
+
+
 def test_integer_array_dataset(tmp_path):
     event_page_info = [
         {
@@ -270,7 +652,82 @@ def test_integer_array_dataset(tmp_path):
             1,
             *reversed(desc_data_keys["Synced_saxs_image"]["shape"][:2]),
         )
+        # one timestamp per event, not one per pixel
+        assert h5_events_primary["timestamps"]["Synced_saxs_image"].shape == (1,)
         assert np.all(
             h5_events_primary["timestamps"]["Synced_saxs_image"][()]
             == event_page_info[0]["timestamps"]["Synced_saxs_image"]
         )
+
+
+def test_compression_tuple_and_compression_opts(tmp_path):
+    with pytest.raises(ValueError, match="compression_opts"):
+        nxsas.Serializer(
+            directory=tmp_path, compression=("gzip", 4), compression_opts=9
+        )
+
+
+def test_array_dataset_compression(tmp_path):
+    event_page_info = [
+        {
+            "seq_num": [1],
+            "data": {
+                "Synced_saxs_image": [
+                    np.random.randint(low=3000, high=6000, size=(6, 4), dtype=np.uint32)
+                ],
+            },
+            "timestamps": {"Synced_saxs_image": [1573882944.765147]},
+        },
+    ]
+    desc_data_keys = {
+        "Synced_saxs_image": {
+            "shape": [4, 6, 0],
+            "source": "PV:XF:07ID1-ES:1{GE:1}",
+            "dtype": "array",
+            "external": "FILESTORE:",
+            "object_name": "Synced",
+        }
+    }
+
+    # the default is bitshuffle+LZ4 from hdf5plugin
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path / "default",
+        desc_data_keys=desc_data_keys,
+        event_page_data_and_timestamps_list=event_page_info,
+    )
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        assert _filter_ids(h5_events_primary["data"]["Synced_saxs_image"]) == [
+            hdf5plugin.BSHUF_ID
+        ]
+        assert np.all(
+            h5_events_primary["data"]["Synced_saxs_image"][()]
+            == event_page_info[0]["data"]["Synced_saxs_image"]
+        )
+        assert _filter_ids(h5_events_primary["timestamps"]["Synced_saxs_image"]) == [
+            h5py.h5z.FILTER_SHUFFLE,
+            h5py.h5z.FILTER_DEFLATE,
+        ]
+
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path / "uncompressed",
+        desc_data_keys=desc_data_keys,
+        event_page_data_and_timestamps_list=event_page_info,
+        compression=None,
+    )
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_events_primary = h["bluesky"]["events"]["primary"]
+        assert _filter_ids(h5_events_primary["data"]["Synced_saxs_image"]) == []
+
+    h5_output_filepath = export_h5_file(
+        output_directory=tmp_path / "gzip",
+        desc_data_keys=desc_data_keys,
+        event_page_data_and_timestamps_list=event_page_info,
+        compression=("gzip", 4),
+        shuffle=True,
+    )
+    with h5py.File(h5_output_filepath, "r") as h:
+        h5_saxs_image = h["bluesky"]["events"]["primary"]["data"]["Synced_saxs_image"]
+        assert h5_saxs_image.compression == "gzip"
+        assert h5_saxs_image.compression_opts == 4
+        assert h5_saxs_image.shuffle
@@ -0,0 +1,23 @@
+import h5py
+
+from suitcase.nxsas import get_h5_dataset_chunks
+
+
+def test_get_h5_dataset_chunks():
+    # scalars are limited by max_chunk_rows
+    assert get_h5_dataset_chunks(row_shape=(), h5_dtype="f8") == (1024,)
+    assert get_h5_dataset_chunks(row_shape=(), h5_dtype=h5py.string_dtype()) == (1024,)
+
+    # about 1MiB per chunk
+    assert get_h5_dataset_chunks(row_shape=(1024,), h5_dtype="f8") == (128, 1024)
+
+    # rows larger than 1MiB get one row per chunk
+    assert get_h5_dataset_chunks(row_shape=(1026, 1024), h5_dtype="u4") == (
+        1,
+        1026,
+        1024,
+    )
+
+    assert get_h5_dataset_chunks(
+        row_shape=(4,), h5_dtype="i4", chunk_nbytes=64, max_chunk_rows=10
+    ) == (4, 4)
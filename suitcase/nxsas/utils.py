@@ -1,5 +1,4 @@
-from collections import Mapping, Sequence
-import copy
+from collections.abc import Mapping, Sequence
 import json
 import logging
 import re
@@ -7,6 +6,47 @@ import re
 import h5py
 import numpy as np
 
+log = logging.getLogger("suitcase.nxsas")
+
+# property lists shared by every group created by _create_h5_group
+# create intermediate groups and UTF-8 link names as h5py does
+_h5_group_lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+_h5_group_lcpl.set_create_intermediate_group(True)
+_h5_group_lcpl.set_char_encoding(h5py.h5t.CSET_UTF8)
+# do not track link creation order or object modification times
+_h5_group_gcpl = h5py.h5p.create(h5py.h5p.GROUP_CREATE)
+_h5_group_gcpl.set_link_creation_order(0)
+_h5_group_gcpl.set_obj_track_times(False)
+
+
+def _create_h5_group(h5_group, name):
+    """
+    Create a new group in h5_group, like h5_group.create_group(name).
+
+    The group tracks neither link creation order nor modification times and
+    the h5 property lists are not created again for every group, which makes
+    this about twice as fast as create_group.
+
+    Parameters
+    ----------
+    h5_group: h5py.Group or h5py.File
+        parent of the new group
+    name: str
+        name of the new group
+
+    Returns
+    -------
+    h5py.Group
+    """
+    return h5py.Group(
+        h5py.h5g.create(
+            h5_group.id,
+            name.encode("utf-8"),
+            lcpl=_h5_group_lcpl,
+            gcpl=_h5_group_gcpl,
+        )
+    )
+
 
 def _copy_nexus_md_to_nexus_h5(nexus_md, h5_group_or_dataset):
     """
@@ -198,7 +238,9 @@ def _copy_nexus_md_to_nexus_h5(nexus_md, h5_group_or_dataset):
                 # otherwise create a group
                 _copy_nexus_md_to_nexus_h5(
                     nexus_md=nexus_value,
-                    h5_group_or_dataset=h5_group_or_dataset.create_group(nexus_key),
+                    h5_group_or_dataset=_create_h5_group(
+                        h5_group_or_dataset, nexus_key
+                    ),
                 )
         elif isinstance(nexus_value, str) and nexus_value.startswith("#bluesky"):
             # create a link
@@ -237,27 +279,26 @@ def _parse_bluesky_document_path(bluesky_document_path):
     if m is None:
         raise Exception(f"failed to parse '{bluesky_document_path}'")
     else:
-        path_info = copy.copy(m.groupdict())
-        if path_info["doc"].startswith("desc"):
+        # groupdict() returns a new dict so there is no need to copy it
+        path_info = m.groupdict()
+        if path_info["stream"] is not None:
             # path_info["doc"] is "desc/stream_name"
-            # but I want just "desc" so split off "/stream_name
-            path_info["doc"] = path_info["doc"].split("/")[0]
+            # but I want just "desc", the stream name is in path_info["stream"]
+            path_info["doc"] = "desc"
         # path_info["all_keys"] is something like "/abc/def"
         # but I want a tuple like ("abc", "def") so split on "/"
         # the first element of the split list is an empty string
         # leave it out with [1:]
-        path_info["keys"] = tuple(path_info["all_keys"].split("/"))[1:]
+        path_info["keys"] = tuple(path_info["all_keys"].split("/")[1:])
 
     return path_info
 
 
 def _get_h5_group_or_dataset(bluesky_document_path, h5_file):
     # look up the h5 group corresponding to the bluesky document path
+    # with one path lookup rather than indexing one group at a time
     doc = bluesky_document_path["doc"]
-    h5_target_group = h5_file["bluesky"][doc]
-    for key in bluesky_document_path["keys"]:
-        h5_target_group = h5_target_group[key]
-    return h5_target_group
+    return h5_file["/".join(("bluesky", doc, *bluesky_document_path["keys"]))]
 
 
 def _copy_metadata_to_h5_attrs(a_mapping, h5_group):
@@ -271,7 +312,7 @@ def _copy_metadata_to_h5_attrs(a_mapping, h5_group):
             # create a new h5 group for it
             # and recursively copy its keys and values to h5 groups and attributes
             _copy_metadata_to_h5_attrs(
-                a_mapping=value, h5_group=h5_group.create_group(key)
+                a_mapping=value, h5_group=_create_h5_group(h5_group, key)
             )
         else:
             # a special case
@@ -289,22 +330,28 @@ def _copy_metadata_to_h5_attrs(a_mapping, h5_group):
                 h5_group.attrs[key] = json.dumps(value)
 
 
-def _copy_metadata_to_h5_datasets(a_mapping, h5_group):
+def _copy_metadata_to_h5_datasets(a_mapping, h5_group, scalars_as_attrs=False):
     """
     Recursively reproduce a python "mapping" (typically a dict)
     as h5 nested groups and datasets. This function is intended
     to be used when h5 attributes are not desirable, for example
     if we want to create h5 links to the resulting datasets.
+
+    If scalars_as_attrs is True then scalar values such as str, int,
+    and float are stored as attributes of their group rather than as
+    datasets. Attributes are kept in the group's object header so this
+    writes much less h5 metadata, but h5 links to them can not be created.
     """
-    log = logging.Logger("suitcase.nxsas", level="DEBUG")
     for key, value in a_mapping.items():
         if isinstance(value, Mapping):
             # found a dict-like value
             # create a new h5 group for it
             # and recursively copy its keys and values to h5 groups and datasets
-            group = h5_group.create_group(key)
+            group = _create_h5_group(h5_group, key)
             log.debug("created h5 group %s", group)
-            _copy_metadata_to_h5_datasets(a_mapping=value, h5_group=group)
+            _copy_metadata_to_h5_datasets(
+                a_mapping=value, h5_group=group, scalars_as_attrs=scalars_as_attrs
+            )
         else:
             # a special case
             if value is None:
@@ -324,6 +371,23 @@ def _copy_metadata_to_h5_datasets(a_mapping, h5_group):
                 # will cause a ValueError: VLEN strings do not support embedded NULLs
                 value = ""
 
+            if scalars_as_attrs and isinstance(
+                value, (str, bytes, bool, int, float, np.generic)
+            ):
+                # this is where an h5 attribute is assigned
+                try:
+                    h5_group.attrs[key] = value
+                    log.debug("created attribute %s in %s", key, h5_group)
+                    continue
+                except (TypeError, ValueError, OverflowError) as err:
+                    # for example an int beyond 64 bits or a str with
+                    # an embedded NUL, store it as a dataset instead
+                    log.info(
+                        "handling exception '%s' by creating a dataset rather than an attribute for key '%s'",
+                        err,
+                        key,
+                    )
+
             # this is where an h5 dataset is assigned
             # string datasets are special because they must be explicitly
             # converted to a numpy array with dtype=h5py.string_dtype()
@@ -332,26 +396,36 @@ def _copy_metadata_to_h5_datasets(a_mapping, h5_group):
                 # use Sequence to handle list and tuple
                 if isinstance(value, str) or (
                     isinstance(value, Sequence)
-                    and all([isinstance(x, str) for x in value])
+                    and all(isinstance(x, str) for x in value)
                 ):
                     d = h5_group.create_dataset(
-                        name=key, data=np.array(value, dtype=h5py.string_dtype())
+                        name=key,
+                        data=np.array(value, dtype=h5py.string_dtype()),
+                        track_times=False,
                     )
                 else:
-                    d = h5_group.create_dataset(name=key, data=value)
-            except TypeError as err:
-                # TypeError occurs if the 'value' is too complex for create_dataset.
+                    d = h5_group.create_dataset(
+                        name=key, data=value, track_times=False
+                    )
+            except (TypeError, ValueError, OverflowError) as err:
+                # TypeError occurs if the 'value' is too complex for create_dataset,
+                # ValueError if a string has an embedded NUL.
                 # Handle this exception by JSON-encoding `value`.
+                # JSON has no bytes type so store bytes as an opaque value.
                 log.info(
                     "handling exception '%s' by JSON-encoding value '%s' for key '%s'",
                     err,
                     value,
                     key,
                 )
-                d = h5_group.create_dataset(
-                    name=key,
-                    data=np.array(json.dumps(value), dtype=h5py.string_dtype()),
-                )
+                # the dataset may have been created before writing the value failed
+                if key in h5_group:
+                    del h5_group[key]
+                if isinstance(value, bytes):
+                    data = np.void(value)
+                else:
+                    data = np.array(json.dumps(value), dtype=h5py.string_dtype())
+                d = h5_group.create_dataset(name=key, data=data, track_times=False)
             except BaseException as ex:
                 # all other exceptions will be logged and allowed to propagate
                 log.error(